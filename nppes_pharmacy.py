@@ -1,12 +1,22 @@
 import os
+import re
+import errno
+import csv
+import html
 import shutil
 import zipfile
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import datetime
-import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 # ---------------------------------------------
 # CONFIGURATION
@@ -24,6 +34,23 @@ ARCHIVE_OTHERNAME_PFILE_DIR = ARCHIVE_DIR / 'othername_pfile'
 
 TODAY = datetime.date.today().isoformat()
 OUTPUT_FILE = ROOT / f"npi_pharmacies_{TODAY}.csv"
+# Columnar copy of the output, loaded by the Streamlit viewer
+OUTPUT_PARQUET_FILE = OUTPUT_FILE.with_suffix('.parquet')
+
+# Matches the href of the <a> whose text names the monthly full file
+DOWNLOAD_LINK_PATTERN = re.compile(
+    r'<a\s[^>]*href=["\']([^"\']+)["\'][^>]*>[^<]*NPPES Data Dissemination V\.2',
+    re.IGNORECASE
+)
+
+# Copy buffer for streaming the multi-GB NPPES zip and its members to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Zip members extracted from the NPPES download
+NEEDED_ZIP_MEMBER_PREFIXES = ('npidata_pfile', 'othername_pfile')
+
+# Size of each slice of the NPI file handed to a filter worker
+NPI_RANGE_SIZE = 64 << 20
 
 # Define standardized column order
 STANDARD_COLUMNS = [
@@ -40,25 +67,30 @@ STANDARD_COLUMNS = [
     'Provider License Number State Code_1'
 ]
 
+# Columns read from the NPI file: everything we keep except the OTHERNAME
+# field, plus the columns only used for filtering
+NPI_OUTPUT_COLUMNS = [
+    col for col in STANDARD_COLUMNS if col != 'Provider Other Organization Name_y'
+]
+NPI_FILTER_COLUMNS = ['Entity Type Code', 'NPI Deactivation Date']
+NPI_READ_COLUMNS = NPI_OUTPUT_COLUMNS + NPI_FILTER_COLUMNS
+
 # ---------------------------------------------
 # STEP 1: Download NPPES ZIP
 # ---------------------------------------------
 def download_nppes_zip():
     url = "https://download.cms.gov/nppes/NPI_Files.html"
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
     print(f"[INFO] Fetching index page: {url}")
-    response = requests.get(url)
+    response = session.get(url)
     response.raise_for_status()
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    links = soup.find_all('a')
-    target_link = None
-    for link in links:
-        if "NPPES Data Dissemination V.2" in link.text:
-            target_link = link.get('href')
-            break
-
-    if not target_link:
+    match = DOWNLOAD_LINK_PATTERN.search(response.text)
+    if not match:
         raise Exception("Download link not found on CMS page.")
+    target_link = html.unescape(match.group(1))
 
     full_download_url = requests.compat.urljoin(url, target_link)
     print(f"[INFO] Found download link: {full_download_url}")
@@ -66,11 +98,16 @@ def download_nppes_zip():
     local_zip_path = ROOT / "nppes_data.zip"
     print(f"[INFO] Downloading to: {local_zip_path}")
 
-    with requests.get(full_download_url, stream=True) as r:
+    with session.get(full_download_url, stream=True) as r:
         r.raise_for_status()
+        # Read straight from the raw urllib3 stream in large blocks rather
+        # than iterating small chunks through iter_content.
+        r.raw.decode_content = True
         with open(local_zip_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+            shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+            # Make sure the zip is fully on disk before unzip_file opens it
+            f.flush()
+            os.fsync(f.fileno())
 
     print("[INFO] Download complete.")
     return local_zip_path
@@ -80,13 +117,33 @@ def download_nppes_zip():
 # ---------------------------------------------
 def unzip_file(zip_path):
     dest = ROOT / "unzipped"
+    dest.mkdir(parents=True, exist_ok=True)
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(dest)
+        for info in zip_ref.infolist():
+            # Only the NPI and OTHERNAME data files are used downstream
+            fname = Path(info.filename).name
+            if info.is_dir() or fname.lower().endswith('_fileheader.csv'):
+                continue
+            if not fname.lower().startswith(NEEDED_ZIP_MEMBER_PREFIXES):
+                continue
+
+            with zip_ref.open(info) as src, open(dest / fname, 'wb') as dst:
+                shutil.copyfileobj(src, dst, length=DOWNLOAD_CHUNK_SIZE)
     print(f"[INFO] Unzipped to: {dest}")
 
 # ---------------------------------------------
 # STEP 3: Move Files to Input Directories
 # ---------------------------------------------
+def rename_file(src, dest):
+    # Same-filesystem rename is a metadata-only operation; only copy the
+    # bytes when the directories are on different devices
+    try:
+        os.replace(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(str(src), str(dest))
+
 def move_files():
     unzipped_dir = ROOT / 'unzipped'
     NPI_PFILE_DIR.mkdir(parents=True, exist_ok=True)
@@ -102,49 +159,116 @@ def move_files():
         if fname.startswith('npidata_pfile'):
             dest = NPI_PFILE_DIR / file.name
             print(f"[INFO] Moving NPI file: {file} -> {dest}")
-            shutil.move(str(file), str(dest))
+            rename_file(file, dest)
 
         elif fname.startswith('othername_pfile'):
             dest = OTHERNAME_PFILE_DIR / file.name
             print(f"[INFO] Moving OTHERNAME file: {file} -> {dest}")
-            shutil.move(str(file), str(dest))
+            rename_file(file, dest)
 
     print("[INFO] Files moved to input directories.")
 
 # ---------------------------------------------
 # STEP 4: Filter NPI File
 # ---------------------------------------------
+# Parse options shared by the parallel and sequential NPI readers
+NPI_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    column_types={col: pa.string() for col in NPI_READ_COLUMNS},
+    include_columns=NPI_READ_COLUMNS,
+    # Keep empty fields as "" so no fillna pass is needed
+    strings_can_be_null=False,
+    quoted_strings_can_be_null=False
+)
+
+def split_csv_ranges(csv_path, range_size):
+    # Returns the header column names and newline-aligned (start, length)
+    # byte ranges covering the data rows.
+    # ASSUMES no quoted field contains a newline: boundaries are placed at
+    # raw line breaks without tracking quotes. If that ever breaks, the
+    # worker parse fails and filter_npi_file falls back to a sequential read.
+    size = os.path.getsize(csv_path)
+    ranges = []
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + range_size, size))
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end - start))
+            start = end
+
+    column_names = next(csv.reader([header.decode('utf-8-sig')]))
+    return column_names, ranges
+
+def filter_npi_chunk(chunk, taxonomy_codes):
+    # Keep rows where all of these hold, evaluated as one combined mask:
+    # 1. Entity Type Code = 2
+    # 2. NPI Deactivation Date is empty
+    # 3. Taxonomy code match
+    mask = pc.and_kleene(
+        pc.and_kleene(
+            pc.equal(chunk['Entity Type Code'], '2'),
+            pc.equal(pc.utf8_trim_whitespace(chunk['NPI Deactivation Date']), '')
+        ),
+        pc.is_in(chunk['Healthcare Provider Taxonomy Code_1'], value_set=taxonomy_codes)
+    )
+    before = chunk.num_rows
+    chunk = chunk.filter(mask)
+    print(f"[DEBUG] Filters removed {before - chunk.num_rows} of {before} rows")
+
+    # Filter-only columns are not needed past this point
+    return chunk.select(NPI_OUTPUT_COLUMNS)
+
+def filter_npi_range(npi_file_path, column_names, taxonomy_codes, byte_range):
+    start, length = byte_range
+    with open(npi_file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(length)
+
+    chunk = pacsv.read_csv(
+        pa.BufferReader(data),
+        read_options=pacsv.ReadOptions(column_names=column_names, use_threads=False),
+        convert_options=NPI_CONVERT_OPTIONS
+    )
+    return filter_npi_chunk(chunk, taxonomy_codes)
+
+def filter_npi_sequential(npi_file_path, taxonomy_codes):
+    reader = pacsv.open_csv(
+        npi_file_path,
+        read_options=pacsv.ReadOptions(block_size=64 << 20),
+        convert_options=NPI_CONVERT_OPTIONS
+    )
+    return [
+        pa.Table.from_batches([filter_npi_chunk(batch, taxonomy_codes)])
+        for batch in reader
+    ]
+
 def filter_npi_file(npi_file_path, taxonomy_file_path):
     print(f"[INFO] Filtering NPI file: {npi_file_path}")
     taxonomy_df = pd.read_csv(taxonomy_file_path, dtype=str)
-    taxonomy_codes = set(taxonomy_df['Taxonomy Code'].dropna())
-
-    chunksize = 500000
-    filtered_chunks = []
-
-    for chunk in pd.read_csv(npi_file_path, chunksize=chunksize, dtype=str):
-        chunk.fillna("", inplace=True)
-
-        # 1. Entity Type Code = 2
-        before_entity = len(chunk)
-        chunk = chunk[chunk['Entity Type Code'] == '2']
-        print(f"[DEBUG] Entity Type filter removed {before_entity - len(chunk)} rows")
+    # Built once and shared by every chunk's is_in lookup
+    taxonomy_codes = pa.array(
+        sorted(frozenset(taxonomy_df['Taxonomy Code'].dropna())), type=pa.string()
+    )
 
-        # 2. NPI Deactivation Date is empty
-        before_deactivation = len(chunk)
-        chunk = chunk[chunk['NPI Deactivation Date'].str.strip() == ""]
-        print(f"[DEBUG] Deactivation filter removed {before_deactivation - len(chunk)} rows")
+    # Each worker parses and filters its own slice of the file
+    column_names, ranges = split_csv_ranges(npi_file_path, NPI_RANGE_SIZE)
+    worker = partial(filter_npi_range, npi_file_path, column_names, taxonomy_codes)
 
-        # 3. Taxonomy code match
-        before_taxonomy = len(chunk)
-        chunk = chunk[chunk['Healthcare Provider Taxonomy Code_1'].isin(taxonomy_codes)]
-        print(f"[DEBUG] Taxonomy filter removed {before_taxonomy - len(chunk)} rows")
+    try:
+        with ProcessPoolExecutor() as executor:
+            filtered_chunks = list(executor.map(worker, ranges))
+    except pa.ArrowInvalid as e:
+        # A slice boundary landed inside a quoted field; a streaming read
+        # handles quoting correctly
+        print(f"[WARN] Parallel parse failed ({e}); filtering sequentially.")
+        filtered_chunks = filter_npi_sequential(npi_file_path, taxonomy_codes)
 
-        if not chunk.empty:
-            filtered_chunks.append(chunk)
+    filtered_chunks = [chunk for chunk in filtered_chunks if chunk.num_rows]
 
     if filtered_chunks:
-        filtered_df = pd.concat(filtered_chunks, ignore_index=True)
+        filtered_df = pa.concat_tables(filtered_chunks).to_pandas()
         print(f"[INFO] Filtered total rows: {len(filtered_df)}")
         return filtered_df
     else:
@@ -154,22 +278,49 @@ def filter_npi_file(npi_file_path, taxonomy_file_path):
 # ---------------------------------------------
 # STEP 5: Merge with OTHERNAME
 # ---------------------------------------------
+# Only the two OTHERNAME columns used by the join are parsed, and empty
+# names stay "" so the file never needs a fillna pass
+OTHERNAME_COLUMNS = ['NPI', 'Provider Other Organization Name']
+OTHERNAME_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    column_types={col: pa.string() for col in OTHERNAME_COLUMNS},
+    include_columns=OTHERNAME_COLUMNS,
+    strings_can_be_null=False,
+    quoted_strings_can_be_null=False
+)
+
 def merge_othername(filtered_df, othername_file_path):
     print(f"[INFO] Merging with OTHERNAME file: {othername_file_path}")
-    othername_df = pd.read_csv(othername_file_path, dtype=str)
-    othername_df.fillna("", inplace=True)
-
-    merged = pd.merge(
-        filtered_df,
-        othername_df[['NPI', 'Provider Other Organization Name']],
-        on='NPI',
-        how='left'
+    othername = pacsv.read_csv(
+        othername_file_path,
+        convert_options=OTHERNAME_CONVERT_OPTIONS
     )
 
     # Rename to _y suffix explicitly
-    merged = merged.rename(columns={
-        'Provider Other Organization Name': 'Provider Other Organization Name_y'
-    })
+    othername = othername.rename_columns(['NPI', 'Provider Other Organization Name_y'])
+    othername = othername.append_column(
+        '_othername_row', pa.array(np.arange(othername.num_rows, dtype=np.int64))
+    )
+
+    # Arrow's hash join does not keep row order, so carry the original
+    # positions of both sides through the join and sort on them afterwards
+    filtered = pa.Table.from_pandas(
+        filtered_df,
+        schema=pa.schema([(col, pa.string()) for col in filtered_df.columns]),
+        preserve_index=False
+    )
+    filtered = filtered.append_column('_row', pa.array(np.arange(filtered.num_rows, dtype=np.int64)))
+
+    # Acero builds its hash table on the right input, so put the small
+    # pharmacy table there and probe it with the large OTHERNAME table
+    joined = othername.join(filtered, keys='NPI', join_type='right outer')
+    joined = joined.sort_by([('_row', 'ascending'), ('_othername_row', 'ascending')])
+    joined = joined.drop_columns(['_row', '_othername_row'])
+    joined = joined.set_column(
+        joined.schema.get_field_index('Provider Other Organization Name_y'),
+        'Provider Other Organization Name_y',
+        pc.fill_null(joined['Provider Other Organization Name_y'], '')
+    )
+    merged = joined.to_pandas()
 
     # Ensure standard columns exist
     for col in STANDARD_COLUMNS:
@@ -189,9 +340,9 @@ def archive_input_files():
     for dirpath in [NPI_PFILE_DIR, OTHERNAME_PFILE_DIR]:
         for file in dirpath.iterdir():
             if 'npidata_pfile' in file.name.lower():
-                shutil.move(str(file), str(ARCHIVE_NPI_PFILE_DIR / file.name))
+                rename_file(file, ARCHIVE_NPI_PFILE_DIR / file.name)
             elif 'othername_pfile' in file.name.lower():
-                shutil.move(str(file), str(ARCHIVE_OTHERNAME_PFILE_DIR / file.name))
+                rename_file(file, ARCHIVE_OTHERNAME_PFILE_DIR / file.name)
     print("[INFO] Archived processed input files.")
 
 # ---------------------------------------------
@@ -200,8 +351,6 @@ def archive_input_files():
 def main():
     try:
         zip_path = download_nppes_zip()
-        print("[INFO] Waiting 40 seconds for large download assurance...")
-        time.sleep(40)
 
         unzip_file(zip_path)
         move_files()
@@ -222,8 +371,16 @@ def main():
             return
 
         final_df = merge_othername(filtered_npi_df, othername_file)
-        final_df.to_csv(OUTPUT_FILE, index=False)
+        # Convert once and write both outputs from Arrow in native code
+        final_table = pa.Table.from_pandas(final_df, preserve_index=False)
+        pacsv.write_csv(
+            final_table,
+            OUTPUT_FILE,
+            write_options=pacsv.WriteOptions(batch_size=65536)
+        )
         print(f"[SUCCESS] Saved final output: {OUTPUT_FILE}")
+        pq.write_table(final_table, OUTPUT_PARQUET_FILE, compression='zstd')
+        print(f"[SUCCESS] Saved Parquet output: {OUTPUT_PARQUET_FILE}")
 
         archive_input_files()
 
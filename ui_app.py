@@ -1,8 +1,11 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from collections import defaultdict
 import datetime
 import io
+import sqlite3
 
 # -------------------------------
 # CONFIG
@@ -10,7 +13,10 @@ import io
 ROOT = Path(__file__).resolve().parent
 TODAY = datetime.date.today().isoformat()
 CSV_FILE = ROOT / f"npi_pharmacies_{TODAY}.csv"
+PARQUET_FILE = CSV_FILE.with_suffix('.parquet')
 GROUP_CSV = ROOT / "group_pharmacies.csv"
+GROUP_DB = ROOT / "group_pharmacies.db"
+GROUP_COLUMNS = ['Group Name', 'NPI', 'Pharmacy Name', 'Start Date', 'End Date']
 
 # Define the standard columns
 STANDARD_COLUMNS = [
@@ -42,30 +48,111 @@ DISPLAY_LABELS = {
     'Provider License Number State Code_1': 'License State'
 }
 
+# Low-cardinality columns used by the sidebar filters
+CATEGORY_COLUMNS = [
+    'Healthcare Provider Taxonomy Code_1',
+    'Provider Business Practice Location Address State Name'
+]
+
 # -------------------------------
-# Load CSV Data
+# Load Data
 # -------------------------------
 @st.cache_data
 def load_data(path):
-    df = pd.read_csv(path, dtype=str)
+    # Prefer the Parquet output; older runs only produced the CSV
+    if path.suffix == '.parquet':
+        df = pd.read_parquet(path, engine='pyarrow', dtype_backend='pyarrow')
+    else:
+        df = pd.read_csv(path, dtype=str)
     df.fillna("", inplace=True)
     for col in STANDARD_COLUMNS:
         if col not in df.columns:
             df[col] = ""
-    return df[STANDARD_COLUMNS]
+    df = df[STANDARD_COLUMNS].copy()
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype('category')
+    # Lowercased copies of the searchable names, computed once per load
+    df['_org_lower'] = df['Provider Organization Name (Legal Business Name)'].str.lower()
+    df['_other_lower'] = df['Provider Other Organization Name_y'].str.lower()
+    return df
+
+# -------------------------------
+# Search Index
+# -------------------------------
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+@st.cache_resource
+def load_search_index(path):
+    # Map each trigram of the lowercased names to the sorted row positions
+    # containing it. Both names are joined with a newline, which a search
+    # term can never contain, so no false trigram spans the two fields.
+    df = load_data(path)
+    postings = defaultdict(list)
+    names = df['_org_lower'].astype(str) + '\n' + df['_other_lower'].astype(str)
+    for row, name in enumerate(names):
+        for gram in trigrams(name):
+            postings[gram].append(row)
+    return {gram: np.array(rows, dtype=np.int32) for gram, rows in postings.items()}
+
+def search_rows(df, search_index, term):
+    # Candidate rows come from intersecting the term's trigram postings,
+    # smallest first; short terms have no trigrams and scan every row.
+    # Candidates are then checked with a substring match.
+    grams = trigrams(term)
+    if grams:
+        postings = sorted(
+            (search_index.get(gram, np.empty(0, dtype=np.int32)) for gram in grams),
+            key=len
+        )
+        candidates = postings[0]
+        for rows in postings[1:]:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, rows, assume_unique=True)
+    else:
+        candidates = np.arange(len(df), dtype=np.int32)
+
+    subset = df.iloc[candidates]
+    matched = (
+        subset['_org_lower'].str.contains(term, regex=False)
+        | subset['_other_lower'].str.contains(term, regex=False)
+    )
+    return candidates[matched.to_numpy(dtype=bool)]
+
+# -------------------------------
+# Group Store
+# -------------------------------
+def open_group_db():
+    # Creates the groups table on first use and imports any existing
+    # group_pharmacies.csv so earlier assignments carry over
+    is_new = not GROUP_DB.exists()
+    conn = sqlite3.connect(GROUP_DB)
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS groups ('
+        '"Group Name" TEXT, "NPI" TEXT, "Pharmacy Name" TEXT, "Start Date" TEXT, "End Date" TEXT)'
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_groups_npi ON groups ("NPI")')
+    if is_new and GROUP_CSV.exists():
+        legacy_df = pd.read_csv(GROUP_CSV, dtype=str).fillna("")
+        legacy_df[GROUP_COLUMNS].to_sql('groups', conn, if_exists='append', index=False)
+    conn.commit()
+    return conn
 
 # -------------------------------
 # App Start
 # -------------------------------
 st.set_page_config(page_title="Pharmacy Directory Viewer", layout="wide")
 st.title("Pharmacy Directory Viewer")
-st.markdown(f"**Data Source:** `{CSV_FILE.name}`")
+DATA_FILE = PARQUET_FILE if PARQUET_FILE.exists() else CSV_FILE
+st.markdown(f"**Data Source:** `{DATA_FILE.name}`")
 
-if not CSV_FILE.exists():
-    st.error(f"Data file not found: {CSV_FILE}")
+if not DATA_FILE.exists():
+    st.error(f"Data file not found: {DATA_FILE}")
     st.stop()
 
-df = load_data(CSV_FILE)
+df = load_data(DATA_FILE)
+search_index = load_search_index(DATA_FILE)
 
 # -------------------------------
 # Sidebar Filters
@@ -73,14 +160,14 @@ df = load_data(CSV_FILE)
 with st.sidebar:
     st.header("Filter Pharmacies")
 
-    taxonomy_options = sorted(df['Healthcare Provider Taxonomy Code_1'].unique())
+    taxonomy_options = sorted(df['Healthcare Provider Taxonomy Code_1'].cat.categories)
     selected_taxonomy = st.multiselect(
         "Select Taxonomy Codes",
         options=taxonomy_options,
         default=taxonomy_options
     )
 
-    state_options = sorted(df['Provider Business Practice Location Address State Name'].unique())
+    state_options = sorted(df['Provider Business Practice Location Address State Name'].cat.categories)
     selected_states = st.multiselect(
         "Select States",
         options=state_options,
@@ -95,29 +182,26 @@ with st.sidebar:
 # -------------------------------
 # Apply Filters
 # -------------------------------
-filtered_df = df.copy()
+mask = np.ones(len(df), dtype=bool)
 
 if selected_taxonomy:
-    filtered_df = filtered_df[
-        filtered_df['Healthcare Provider Taxonomy Code_1'].isin(selected_taxonomy)
-    ]
+    mask &= df['Healthcare Provider Taxonomy Code_1'].isin(selected_taxonomy).to_numpy()
 
 if selected_states:
-    filtered_df = filtered_df[
-        filtered_df['Provider Business Practice Location Address State Name'].isin(selected_states)
-    ]
+    mask &= df['Provider Business Practice Location Address State Name'].isin(selected_states).to_numpy()
 
 if search_term.strip():
     term = search_term.lower()
-    filtered_df = filtered_df[
-        filtered_df['Provider Organization Name (Legal Business Name)'].str.lower().str.contains(term)
-        | filtered_df['Provider Other Organization Name_y'].str.lower().str.contains(term)
-    ]
+    matches = np.zeros(len(df), dtype=bool)
+    matches[search_rows(df, search_index, term)] = True
+    mask &= matches
+
+filtered_df = df.loc[mask]
 
 # -------------------------------
 # Display Filtered Table
 # -------------------------------
-display_df = filtered_df.rename(columns=DISPLAY_LABELS)
+display_df = filtered_df[STANDARD_COLUMNS].rename(columns=DISPLAY_LABELS)
 
 st.subheader(f"Results: {len(display_df)} pharmacies found")
 st.dataframe(display_df, use_container_width=True)
@@ -127,10 +211,14 @@ st.dataframe(display_df, use_container_width=True)
 # -------------------------------
 st.subheader("📌 Step 1: Select Pharmacies for Group")
 
+# NPI -> pharmacy name, keeping the first row for NPIs with several names
+first_rows = filtered_df.drop_duplicates('NPI')
+npi_to_name = dict(zip(first_rows['NPI'], first_rows['Provider Other Organization Name_y']))
+
 selected_npis = st.multiselect(
     "Select pharmacies by NPI:",
     options=filtered_df['NPI'],
-    format_func=lambda npi: f"{npi} - {filtered_df.loc[filtered_df['NPI'] == npi, 'Provider Other Organization Name_y'].values[0] if not filtered_df.loc[filtered_df['NPI'] == npi, 'Provider Other Organization Name_y'].empty else ''}"
+    format_func=lambda npi: f"{npi} - {npi_to_name.get(npi, '')}"
 )
 
 # -------------------------------
@@ -145,6 +233,8 @@ end_date = st.date_input("End Date")
 # -------------------------------
 # Add to Group Button
 # -------------------------------
+group_conn = open_group_db()
+
 if st.button("✅ Add Selected Pharmacies to Group"):
     if not selected_npis:
         st.warning("⚠️ Please select at least one pharmacy.")
@@ -154,24 +244,20 @@ if st.button("✅ Add Selected Pharmacies to Group"):
         # Prepare new records
         new_entries = []
         for npi in selected_npis:
-            pharmacy_name = filtered_df.loc[filtered_df['NPI'] == npi, 'Provider Other Organization Name_y'].values[0]
             new_entries.append({
                 'Group Name': group_name.strip(),
                 'NPI': npi,
-                'Pharmacy Name': pharmacy_name,
+                'Pharmacy Name': npi_to_name[npi],
                 'Start Date': start_date.isoformat(),
                 'End Date': end_date.isoformat()
             })
 
-        # Load existing or create new
-        try:
-            existing_df = pd.read_csv(GROUP_CSV, dtype=str)
-        except FileNotFoundError:
-            existing_df = pd.DataFrame(columns=['Group Name', 'NPI', 'Pharmacy Name', 'Start Date', 'End Date'])
-
-        # Append new
-        updated_df = pd.concat([existing_df, pd.DataFrame(new_entries)], ignore_index=True)
-        updated_df.to_csv(GROUP_CSV, index=False)
+        # Append only the new rows
+        with group_conn:
+            group_conn.executemany(
+                'INSERT INTO groups VALUES (?, ?, ?, ?, ?)',
+                [tuple(entry[col] for col in GROUP_COLUMNS) for entry in new_entries]
+            )
 
         st.success(f"✅ Added {len(new_entries)} pharmacies to group '{group_name}'.")
 
@@ -180,52 +266,76 @@ if st.button("✅ Add Selected Pharmacies to Group"):
 # -------------------------------
 st.subheader("📋 View Existing Groups")
 
-try:
-    groups_df = pd.read_csv(GROUP_CSV, dtype=str)
-    if not groups_df.empty:
-        st.dataframe(groups_df, use_container_width=True)
+# rowid identifies each entry so edits can be saved as targeted statements
+groups_df = pd.read_sql('SELECT rowid AS id, * FROM groups', group_conn)
+if not groups_df.empty:
+    # ⭐️ New Feature: Edit or Delete Entries
+    # Edits are batched in the editor and written on "Save Changes". Bumping
+    # the key version afterwards resets the editor to the saved table.
+    if 'group_editor_version' not in st.session_state:
+        st.session_state.group_editor_version = 0
+    edited_df = st.data_editor(
+        groups_df,
+        num_rows="dynamic",
+        hide_index=True,
+        column_config={'id': None},
+        use_container_width=True,
+        key=f"group_editor_{st.session_state.group_editor_version}"
+    )
+
+    if st.button("💾 Save Changes"):
+        # Rows added in the editor have no rowid yet
+        added_df = edited_df[edited_df['id'].isna()].fillna("")
+        kept_df = edited_df[edited_df['id'].notna()].fillna("").set_index('id')
+        original_df = groups_df.set_index('id')
+        deleted_ids = original_df.index.difference(kept_df.index)
+        updated_df = kept_df[kept_df.ne(original_df.loc[kept_df.index]).any(axis=1)]
 
-        # ⭐️ New Feature: Download CSV
-        csv_data = groups_df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="📥 Download Group Assignments CSV",
-            data=csv_data,
-            file_name="group_pharmacies.csv",
-            mime="text/csv"
-        )
+        with group_conn:
+            group_conn.executemany(
+                'DELETE FROM groups WHERE rowid = ?',
+                [(int(row_id),) for row_id in deleted_ids]
+            )
+            group_conn.executemany(
+                'UPDATE groups SET "Group Name" = ?, "NPI" = ?, "Pharmacy Name" = ?, '
+                '"Start Date" = ?, "End Date" = ? WHERE rowid = ?',
+                list(
+                    updated_df[GROUP_COLUMNS]
+                    .assign(id=updated_df.index.astype(int))
+                    .itertuples(index=False, name=None)
+                )
+            )
+            group_conn.executemany(
+                'INSERT INTO groups VALUES (?, ?, ?, ?, ?)',
+                list(added_df[GROUP_COLUMNS].itertuples(index=False, name=None))
+            )
 
-        # ⭐️ New Feature: Delete Selected Rows
-        st.markdown("---")
-        st.subheader("🗑️ Delete Entries")
-        delete_npis = st.multiselect(
-            "Select entries by NPI to delete from groups:",
-            options=groups_df['NPI'].unique()
+        st.session_state.group_editor_version += 1
+        st.success(
+            f"Saved changes: {len(updated_df)} updated, "
+            f"{len(deleted_ids)} deleted, {len(added_df)} added."
         )
-        if st.button("❌ Delete Selected"):
-            if delete_npis:
-                groups_df = groups_df[~groups_df['NPI'].isin(delete_npis)]
-                groups_df.to_csv(GROUP_CSV, index=False)
-                st.success(f"Deleted entries for NPIs: {', '.join(delete_npis)}")
-                st.experimental_rerun()
-
-        # ⭐️ New Feature: Edit Start/End Dates
-        st.markdown("---")
-        st.subheader("✏️ Edit Start/End Dates for Group Entries")
-        edit_npis = st.multiselect(
-            "Select NPIs to edit:",
-            options=groups_df['NPI'].unique()
+
+    # ⭐️ New Feature: Download
+    # The file is only serialized once the user asks for it
+    st.markdown("---")
+    export_format = st.radio("Download format", ["Parquet", "CSV"], horizontal=True)
+    if st.button("📦 Prepare Download"):
+        buffer = io.BytesIO()
+        if export_format == "Parquet":
+            groups_df[GROUP_COLUMNS].to_parquet(buffer, engine='pyarrow', compression='zstd', index=False)
+            file_name, mime = "group_pharmacies.parquet", "application/vnd.apache.parquet"
+        else:
+            groups_df[GROUP_COLUMNS].to_csv(buffer, index=False)
+            file_name, mime = "group_pharmacies.csv", "text/csv"
+        st.download_button(
+            label=f"📥 Download Group Assignments {export_format}",
+            data=buffer.getvalue(),
+            file_name=file_name,
+            mime=mime
         )
-        new_start = st.date_input("New Start Date for Selected NPIs")
-        new_end = st.date_input("New End Date for Selected NPIs")
-        if st.button("✏️ Apply Date Changes"):
-            if edit_npis:
-                groups_df.loc[groups_df['NPI'].isin(edit_npis), 'Start Date'] = new_start.isoformat()
-                groups_df.loc[groups_df['NPI'].isin(edit_npis), 'End Date'] = new_end.isoformat()
-                groups_df.to_csv(GROUP_CSV, index=False)
-                st.success(f"Updated dates for NPIs: {', '.join(edit_npis)}")
-                st.experimental_rerun()
 
-    else:
-        st.info("No groups found yet. Add some above!")
-except FileNotFoundError:
-    st.info("No `group_pharmacies.csv` found yet. Add a group to create it!")
+else:
+    st.info("No groups found yet. Add some above!")
+
+group_conn.close()